@@ -1,10 +1,17 @@
 #!/usr/bin/env python
 import argparse
+import fnmatch
+import hashlib
+import html
 import json
 import os
 import re
-import string
+import sqlite3
 import sys
+import tempfile
+import time
+from collections import OrderedDict
+from collections.abc import Iterator
 from pathlib import Path
 
 import markdown
@@ -18,18 +25,215 @@ def get_title(text: str) -> str:
     return ""
 
 
+class _NextFinder:
+    """Find the first occurrence of sub at or after a position
+
+    The last answer is cached, so queries which move forward or backward scan each part of text only once."""
+
+    def __init__(self, text: str, sub: str):
+        self.text = text
+        self.sub = sub
+        # The first occurrence at or after low is ans (len(text) if none)
+        self.low = len(text)
+        self.ans = len(text)
+
+    def find(self, pos: int) -> int:
+        n = len(self.text)
+        if pos < self.low:
+            found = self.text.find(self.sub, pos, self.low + len(self.sub) - 1)
+            if found != -1:
+                self.ans = found
+            self.low = pos
+        elif pos > self.ans:
+            found = self.text.find(self.sub, pos)
+            self.ans = n if found == -1 else found
+            self.low = pos
+        return self.ans
+
+
+class _CommentScanner:
+    """Match ``(.+?)\\s*-->`` after the whitespace of a meta comment head like the regular expressions did
+
+    A head ends with whitespace text[h:w], which is ``\\s*`` (min_ws=0) or ``\\s+`` (min_ws=1).
+    Every lookup uses cached finders, so that the total running time is linear in the length of text
+    even for many unterminated comments or long runs of whitespace."""
+
+    def __init__(self, text: str, *, dotall: bool):
+        self.text = text
+        self.dotall = dotall
+        self.closes = _NextFinder(text, "-->")
+        self.newlines = _NextFinder(text, "\n")
+        self.last_close = -1
+        self.last_close_ws_start = -1
+
+    def close_ws_start(self, close: int) -> int:
+        # Start of the whitespace just before "-->" at close
+        if close != self.last_close:
+            pos = close
+            while pos > 0 and self.text[pos - 1].isspace():
+                pos -= 1
+            self.last_close = close
+            self.last_close_ws_start = pos
+        return self.last_close_ws_start
+
+    def match_value(self, h: int, w: int, min_ws: int) -> tuple[int, int] | None:
+        """Return (start, close) of the value, or None if there is no match"""
+        text = self.text
+        close = self.closes.find(w + 1)
+        if close < len(text):
+            if self.dotall or self.newlines.find(w) >= max(w + 1, self.close_ws_start(close)):
+                return w, close
+        # One of the spaces of the head can be the value when "-->" follows them
+        if text.startswith("-->", w):
+            for v in range(w - 1, h + min_ws - 1, -1):
+                if self.dotall or text[v] != "\n":
+                    return v, w
+        return None
+
+
+_WHITESPACE = re.compile(r"\s*+")
+_WHITESPACES = re.compile(r"\s+")
+_OG_DESCRIPTION_HEADS = [
+    (re.compile(r"\s*+og:description:(\s*+)", re.IGNORECASE), 0),
+    (re.compile(r"\s*+og:description(\s++)", re.IGNORECASE), 1),
+]
+_META_TAG_HEADS = [
+    (re.compile(r"\s*+([a-zA-Z_][a-zA-Z0-9_]*+):([a-zA-Z_][a-zA-Z0-9_]*+):(\s*+)", re.IGNORECASE), 0),
+    (re.compile(r"\s*+([a-zA-Z_][a-zA-Z0-9_]*+):([a-zA-Z_][a-zA-Z0-9_]*+)(\s++)", re.IGNORECASE), 1),
+]
+_META_PREFIX = re.compile(r"\s*+(?:og|twitter):", re.IGNORECASE)
+
+
+def remove_code_blocks(text: str) -> str:
+    """Remove code blocks in linear time
+
+    This is the same as ``re.sub(r"```.*?```", "", text, flags=re.DOTALL)``."""
+    pieces = []
+    pos = 0
+    while True:
+        start = text.find("```", pos)
+        if start == -1:
+            break
+        end = text.find("```", start + 3)
+        if end == -1:
+            # No later "```" can be closed either
+            break
+        pieces.append(text[pos:start])
+        pos = end + 3
+    pieces.append(text[pos:])
+    return "".join(pieces)
+
+
+def iter_meta_comments(
+    text: str,
+    *,
+    head: re.Pattern,
+    min_ws: int,
+    dotall: bool,
+) -> Iterator[tuple[int, int, re.Match, str]]:
+    """Yield (start, end, head match, value) of non-overlapping ``<!--HEAD(.+?)\\s*-->`` in linear time
+
+    The last group of head must be the whitespace at its end, and head must not match "<",
+    so that matches from different "<!--" do not overlap."""
+    scanner = _CommentScanner(text, dotall=dotall)
+    pos = 0
+    while True:
+        start = text.find("<!--", pos)
+        if start == -1:
+            return
+        pos = start + 1
+        m = head.match(text, start + 4)
+        if m is None:
+            continue
+        (h, w) = m.span(m.re.groups)
+        found = scanner.match_value(h, w, min_ws)
+        if found is None:
+            continue
+        (value_start, close) = found
+        yield start, close + 3, m, text[value_start:close]
+        pos = close + 3
+
+
+def _remove_prefixed_meta_comments(text: str, *, with_colon: bool) -> str:
+    """Same as re.sub() with ``<!--\\s*(og|twitter):[^:]+:\\s*(.+?)\\s*-->`` (with_colon)
+    or ``<!--\\s*(og|twitter):[^:]+\\s+(.+?)\\s*-->``, in linear time
+
+    ``[^:]+`` runs to the next colon and can span several comments.
+    The results are cached for the colon because all "<!--" before it share it."""
+    n = len(text)
+    scanner = _CommentScanner(text, dotall=False)
+    colons = _NextFinder(text, ":")
+    last_colon = -1
+    # with_colon: the result for last_colon
+    colon_result = None
+    # not with_colon: runs of whitespace before last_colon and the index of the first matching one from the last
+    runs: list[tuple[int, int]] = []
+    run_index = -1
+    run_result = None
+
+    pieces = []
+    pos = 0
+    copied = 0
+    while True:
+        start = text.find("<!--", pos)
+        if start == -1:
+            break
+        pos = start + 1
+        m = _META_PREFIX.match(text, start + 4)
+        if m is None:
+            continue
+        a = m.end()
+        colon = colons.find(a)
+
+        found = None
+        if with_colon:
+            if colon == n or colon == a:
+                continue
+            if colon != last_colon:
+                last_colon = colon
+                ws = _WHITESPACE.match(text, colon + 1)
+                w = colon + 1 if ws is None else ws.end()
+                colon_result = scanner.match_value(colon + 1, w, 0)
+            found = colon_result
+        else:
+            if colon != last_colon:
+                last_colon = colon
+                runs = [mm.span() for mm in _WHITESPACES.finditer(text, a + 1, colon)]
+                run_index = len(runs) - 1
+                run_result = None
+                while run_index >= 0:
+                    (r0, w) = runs[run_index]
+                    run_result = scanner.match_value(r0, w, 1)
+                    if run_result is not None:
+                        break
+                    run_index -= 1
+            if run_index < 0:
+                continue
+            (r0, w) = runs[run_index]
+            if r0 >= a + 1:
+                found = run_result
+            elif w - 1 >= a + 1:
+                found = scanner.match_value(a + 1, w, 1)
+        if found is None:
+            continue
+
+        end = found[1] + 3
+        pieces.append(text[copied:start])
+        copied = end
+        pos = end
+    pieces.append(text[copied:])
+    return "".join(pieces)
+
+
 def get_og_description(text: str) -> str:
     # Remove code blocks to avoid false matches
-    code_block_pattern = r"```.*?```"
-    text_without_code = re.sub(code_block_pattern, "", text, flags=re.DOTALL)
-
-    patterns = [r"<!--\s*og:description:\s*(.+?)\s*-->", r"<!--\s*og:description\s+(.+?)\s*-->"]
-    for pattern in patterns:
-        match = re.search(pattern, text_without_code, re.IGNORECASE | re.DOTALL)
-        if match:
-            description = match.group(1).strip()
+    text_without_code = remove_code_blocks(text)
+
+    for head, min_ws in _OG_DESCRIPTION_HEADS:
+        for _, _, _, value in iter_meta_comments(text_without_code, head=head, min_ws=min_ws, dotall=True):
+            description = value.strip()
             # Replace newlines with <br> tags for og:description
-            description = re.sub(r"\s*\n\s*", "<br>", description)
+            description = _WHITESPACES.sub(lambda m: "<br>" if "\n" in m.group() else m.group(), description)
             return description
     return ""
 
@@ -38,20 +242,14 @@ def check_unsupported_meta_tags(text: str) -> None:
     supported_tags = {"og:description"}
 
     # Remove code blocks to avoid false matches
-    code_block_pattern = r"```.*?```"
-    text_without_code = re.sub(code_block_pattern, "", text, flags=re.DOTALL)
+    text_without_code = remove_code_blocks(text)
 
     # Find all xx:yy format tags in comments
-    patterns = [
-        r"<!--\s*([a-zA-Z_][a-zA-Z0-9_]*):([a-zA-Z_][a-zA-Z0-9_]*):\s*(.+?)\s*-->",
-        r"<!--\s*([a-zA-Z_][a-zA-Z0-9_]*):([a-zA-Z_][a-zA-Z0-9_]*)\s+(.+?)\s*-->",
-    ]
     found_tags = set()
 
-    for pattern in patterns:
-        matches = re.finditer(pattern, text_without_code, re.IGNORECASE)
-        for match in matches:
-            tag_name = f"{match.group(1).lower()}:{match.group(2).lower()}"
+    for head, min_ws in _META_TAG_HEADS:
+        for _, _, m, _ in iter_meta_comments(text_without_code, head=head, min_ws=min_ws, dotall=False):
+            tag_name = f"{m.group(1).lower()}:{m.group(2).lower()}"
             if tag_name not in supported_tags:
                 found_tags.add(tag_name)
 
@@ -62,12 +260,32 @@ def check_unsupported_meta_tags(text: str) -> None:
 
 def remove_meta_comments(text: str) -> str:
     # Original patterns for backward compatibility (still only removes og/twitter tags)
-    patterns = [r"<!--\s*(og|twitter):[^:]+:\s*(.+?)\s*-->", r"<!--\s*(og|twitter):[^:]+\s+(.+?)\s*-->"]
-    for pattern in patterns:
-        text = re.sub(pattern, "", text, flags=re.IGNORECASE)
+    text = _remove_prefixed_meta_comments(text, with_colon=True)
+    text = _remove_prefixed_meta_comments(text, with_colon=False)
     return text
 
 
+def _joined_comment_start(pieces: list[str], content: str, pos: int) -> int:
+    """Return k (1 to 3) if the last k characters of pieces and content[pos:] make "<!--", otherwise 0"""
+    tail = ""
+    for piece in reversed(pieces):
+        tail = piece + tail
+        if len(tail) >= 3:
+            break
+    for k in (3, 2, 1):
+        if tail.endswith("<!--"[:k]) and content.startswith("<!--"[k:], pos):
+            return k
+    return 0
+
+
+def _remove_last_chars(pieces: list[str], k: int) -> None:
+    while k > 0:
+        last = pieces.pop()
+        if len(last) > k:
+            pieces.append(last[:-k])
+        k -= len(last)
+
+
 def remove_html_comments_outside_code_fence(text: str) -> str:
     lines = text.splitlines(keepends=True)
     in_fence = False
@@ -90,30 +308,238 @@ def remove_html_comments_outside_code_fence(text: str) -> str:
             out_lines.append(line)
             continue
 
+        pos = 0
         if in_comment:
             end = content.find("-->")
             if end == -1:
                 out_lines.append(newline)
                 continue
-            content = content[end + 3 :]
+            pos = end + 3
             in_comment = False
 
+        # Kept parts of the line, which never contain "<!--" and are not copied until the end of the line
+        pieces = []
         while True:
-            start = content.find("<!--")
+            start = content.find("<!--", pos)
             if start == -1:
-                out_lines.append(content + newline)
+                pieces.append(content[pos:])
                 break
-            before = content[:start]
+            if start > pos:
+                pieces.append(content[pos:start])
             end = content.find("-->", start + 4)
             if end == -1:
-                out_lines.append(before + newline)
                 in_comment = True
                 break
-            content = before + content[end + 3 :]
+            pos = end + 3
+            # A removed comment can join the parts around it into a new "<!--" like "<!<!-- -->--"
+            while (k := _joined_comment_start(pieces, content, pos)) > 0:
+                _remove_last_chars(pieces, k)
+                end = content.find("-->", pos + 4 - k)
+                if end == -1:
+                    in_comment = True
+                    break
+                pos = end + 3
+            if in_comment:
+                break
+        pieces.append(newline)
+        out_lines.append("".join(pieces))
 
     return "".join(out_lines)
 
 
+_CODE_BLOCK_HTML = re.compile(r'<pre><code class="language-(?P<lang>[^"\s]+)">(?P<code>.*?)</code></pre>', re.DOTALL)
+
+
+class HighlightCache:
+    """Highlighted HTML of code blocks kept on disk under the hash of the language, code and options
+
+    The least recently used entries are removed when the total size exceeds max_bytes."""
+
+    def __init__(self, directory: str, *, max_bytes: int):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        # path -> (last used time, size)
+        self.entries: dict[Path, tuple[float, int]] = {}
+        self.total = 0
+        if self.directory.exists():
+            for path in self.directory.glob("*/*.html"):
+                try:
+                    st = path.stat()
+                except FileNotFoundError:
+                    # Evicted by another process
+                    continue
+                self.entries[path] = (st.st_mtime, st.st_size)
+                self.total += st.st_size
+
+    def path(self, key: str) -> Path:
+        return self.directory / key[:2] / f"{key}.html"
+
+    def get(self, key: str) -> str | None:
+        path = self.path(key)
+        try:
+            with path.open() as fp:
+                ret = fp.read()
+        except FileNotFoundError:
+            return None
+        now = time.time()
+        try:
+            os.utime(path, (now, now))
+            size = path.stat().st_size
+        except FileNotFoundError:
+            # Evicted by another process after reading it
+            self.forget(path)
+            return ret
+        if path in self.entries:
+            self.entries[path] = (now, self.entries[path][1])
+        else:
+            # Written by another process
+            self.entries[path] = (now, size)
+            self.total += size
+            if self.total > self.max_bytes:
+                self.evict()
+        return ret
+
+    def put(self, key: str, value: str):
+        path = self.path(key)
+        path.parent.mkdir(exist_ok=True, parents=True)
+        # Use a unique temporary file so that processes sharing the cache do not write the same one
+        (fd, tmp_name) = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as outf:
+                outf.write(value)
+            os.replace(tmp_name, path)
+        except BaseException:
+            Path(tmp_name).unlink(missing_ok=True)
+            raise
+
+        try:
+            st = path.stat()
+        except FileNotFoundError:
+            # Evicted by another process
+            self.forget(path)
+            return
+        (_, old_size) = self.entries.get(path, (0, 0))
+        self.entries[path] = (st.st_mtime, st.st_size)
+        self.total += st.st_size - old_size
+        if self.total > self.max_bytes:
+            self.evict()
+
+    def forget(self, path: Path):
+        (_, size) = self.entries.pop(path, (0, 0))
+        self.total -= size
+
+    def evict(self):
+        # Evict down to 90% of max_bytes so that eviction does not run on every put
+        for path, (_, size) in sorted(self.entries.items(), key=lambda x: x[1][0]):
+            if self.total <= self.max_bytes * 0.9:
+                break
+            path.unlink(missing_ok=True)
+            del self.entries[path]
+            self.total -= size
+
+
+class Highlighter:
+    """Highlight fenced code blocks with a language by Pygments, reusing the results in HighlightCache"""
+
+    def __init__(
+        self,
+        *,
+        style: str = "default",
+        noclasses: bool = False,
+        cache: HighlightCache | None = None,
+    ):
+        # Pygments is an optional dependency
+        try:
+            import pygments
+            import pygments.formatters
+            import pygments.lexers
+            import pygments.util
+        except ImportError as e:
+            raise RuntimeError("Pygments is required for highlighting: pip install 'pagenerator[highlight]'") from e
+        self.pygments = pygments
+        self.options = {"cssclass": "codehilite", "style": style, "noclasses": noclasses}
+        self.formatter = pygments.formatters.HtmlFormatter(**self.options)
+        self.cache = cache
+
+    def highlight(self, lang: str, code: str) -> str | None:
+        key = None
+        if self.cache is not None:
+            keysrc = json.dumps([self.pygments.__version__, lang, code, self.options], sort_keys=True)
+            key = hashlib.sha256(keysrc.encode()).hexdigest()
+            cached = self.cache.get(key)
+            if cached is not None:
+                return cached
+
+        try:
+            lexer = self.pygments.lexers.get_lexer_by_name(lang)
+        except self.pygments.util.ClassNotFound:
+            return None
+        ret = self.pygments.highlight(code, lexer, self.formatter)
+
+        if self.cache is not None and key is not None:
+            self.cache.put(key, ret)
+        return ret
+
+    def highlight_html(self, content_html: str) -> str:
+        """Replace code blocks generated by fenced_code with highlighted ones"""
+
+        def repl(m: re.Match) -> str:
+            ret = self.highlight(m.group("lang"), html.unescape(m.group("code")))
+            return m.group() if ret is None else ret
+
+        return _CODE_BLOCK_HTML.sub(repl, content_html)
+
+
+_PROTECTED_TAGS = ("pre", "code", "script", "style", "textarea")
+_PROTECTED_TAG = re.compile(rf"<({'|'.join(_PROTECTED_TAGS)})\b", re.IGNORECASE | re.ASCII)
+_PROTECTED_TAG_CLOSES = {tag: re.compile(rf"</{tag}\b", re.IGNORECASE | re.ASCII) for tag in _PROTECTED_TAGS}
+_HTML_WHITESPACES = re.compile(r"[ \t\n\r\f]{2,}|[\t\n\r\f]")
+# A tag with quoted attribute values, which may contain ">", or a run of whitespace elsewhere
+_HTML_TAG_OR_WHITESPACES = re.compile(
+    rf"""(?P<tag><[A-Za-z/!?][^<>"']*(?:(?:"[^"]*"|'[^']*')[^<>"']*)+>)|{_HTML_WHITESPACES.pattern}"""
+)
+_HTML_QUOTED_OR_WHITESPACES = re.compile(rf"""(?P<quoted>"[^"]*"|'[^']*')|{_HTML_WHITESPACES.pattern}""")
+
+
+def _collapse_whitespace(m: re.Match) -> str:
+    if m.group("quoted") is not None:
+        # Attribute values are kept as they are
+        return m.group()
+    return "\n" if "\n" in m.group() else " "
+
+
+def _collapse_html_whitespace(m: re.Match) -> str:
+    if m.group("tag") is not None:
+        tag = m.group()
+        if _HTML_WHITESPACES.search(tag) is None:
+            return tag
+        return _HTML_QUOTED_OR_WHITESPACES.sub(_collapse_whitespace, tag)
+    return "\n" if "\n" in m.group() else " "
+
+
+def minify_html(text: str) -> str:
+    """Collapse runs of whitespace into a space or a newline
+
+    Contents of pre, code, script, style and textarea and quoted attribute values are kept as they are.
+    Only ASCII whitespace is touched, and the text is scanned in linear time."""
+    pieces = []
+    pos = 0
+    while True:
+        m = _PROTECTED_TAG.search(text, pos)
+        if m is None:
+            break
+        pieces.append(_HTML_TAG_OR_WHITESPACES.sub(_collapse_html_whitespace, text[pos : m.start()]))
+        close = _PROTECTED_TAG_CLOSES[m.group(1).lower()].search(text, m.end())
+        if close is None:
+            # Keep the rest as it is when the element is not closed
+            pieces.append(text[m.start() :])
+            return "".join(pieces)
+        pieces.append(text[m.start() : close.start()])
+        pos = close.start()
+    pieces.append(_HTML_TAG_OR_WHITESPACES.sub(_collapse_html_whitespace, text[pos:]))
+    return "".join(pieces)
+
+
 def get_mydict(
     *,
     mydict: dict,
@@ -129,6 +555,182 @@ def get_mydict(
     return thisdict
 
 
+_TEMPLATE_PATTERN = re.compile(
+    r"""
+    \$(?:
+        (?P<escaped>\$) |
+        \{include:(?P<include>[^}]+)\} |
+        (?P<named>(?a:[_a-z][_a-z0-9]*)) |
+        \{(?P<braced>(?a:[_a-z][_a-z0-9]*))\} |
+        (?P<invalid>)
+    )
+    """,
+    re.IGNORECASE | re.VERBOSE,
+)
+
+
+class CompiledTemplate:
+    """A template parsed once into literal and placeholder segments
+
+    The syntax is the same as string.Template, and ``${include:path}`` inserts a partial
+    whose path is relative to the including file."""
+
+    def __init__(
+        self,
+        *,
+        name: str,
+        segments: list[str],
+        placeholders: list[tuple[int, str]],
+        dependencies: dict[str, float],
+    ):
+        self.name = name
+        self.segments = segments
+        self.placeholders = placeholders
+        # mtimes of the template itself and all partials included from it
+        self.dependencies = dependencies
+
+    def is_fresh(self) -> bool:
+        try:
+            return all(os.stat(path).st_mtime == mtime for path, mtime in self.dependencies.items())
+        except FileNotFoundError:
+            return False
+
+    def substitute(self, mapping: dict) -> str:
+        parts = self.segments.copy()
+        for i, name in self.placeholders:
+            parts[i] = str(mapping[name])
+        return "".join(parts)
+
+
+TEMPLATE_CACHE_SIZE = 16
+_template_cache: OrderedDict[str, CompiledTemplate] = OrderedDict()
+# Partials are inlined into their parents, so they are kept apart and do not count for TEMPLATE_CACHE_SIZE
+_partial_cache: dict[str, CompiledTemplate] = {}
+
+
+def compile_template(template_name: str, _stack: tuple[str, ...] = ()) -> CompiledTemplate:
+    """Return the compiled template, which is cached while the template and its partials are not modified"""
+    template_name = os.path.normpath(template_name)
+    if template_name in _stack:
+        raise ValueError(f"Recursive include: {template_name}")
+    is_partial = len(_stack) > 0
+    cached = (_partial_cache if is_partial else _template_cache).get(template_name)
+    if cached is not None and cached.is_fresh():
+        if not is_partial:
+            _template_cache.move_to_end(template_name)
+        return cached
+
+    segments = []
+    placeholders = []
+    dependencies = {template_name: os.stat(template_name).st_mtime}
+    with Path(template_name).open() as fp:
+        text = fp.read()
+
+    literal = []
+    pos = 0
+    for match in _TEMPLATE_PATTERN.finditer(text):
+        literal.append(text[pos : match.start()])
+        pos = match.end()
+        if match.group("escaped") is not None:
+            literal.append("$")
+            continue
+        if match.group("invalid") is not None:
+            lines = text[: match.start()].splitlines(keepends=True)
+            lineno = len(lines) if lines else 1
+            colno = match.start() - len("".join(lines[:-1])) + 1
+            raise ValueError(f"Invalid placeholder in string: line {lineno}, col {colno}")
+
+        segments.append("".join(literal))
+        literal = []
+        include = match.group("include")
+        if include is not None:
+            partial_name = os.path.join(os.path.dirname(template_name), include.strip())
+            partial = compile_template(partial_name, (*_stack, template_name))
+            offset = len(segments)
+            segments.extend(partial.segments)
+            placeholders.extend((offset + i, name) for i, name in partial.placeholders)
+            dependencies.update(partial.dependencies)
+        else:
+            placeholders.append((len(segments), match.group("named") or match.group("braced")))
+            segments.append("")
+    literal.append(text[pos:])
+    segments.append("".join(literal))
+
+    template = CompiledTemplate(
+        name=template_name, segments=segments, placeholders=placeholders, dependencies=dependencies
+    )
+    if is_partial:
+        _partial_cache[template_name] = template
+        return template
+    _template_cache[template_name] = template
+    _template_cache.move_to_end(template_name)
+    while len(_template_cache) > TEMPLATE_CACHE_SIZE:
+        _template_cache.popitem(last=False)
+    return template
+
+
+def get_template_name(
+    *,
+    routes: dict[str, str],
+    relative_filename: str,
+    default: str,
+) -> str:
+    """Return the template for relative_filename
+
+    Keys of routes are path prefixes or glob patterns (when they contain ``*``, ``?`` or ``[``)
+    relative to the input directory, and the first matching one is used."""
+    for pattern, template_name in routes.items():
+        if any(c in pattern for c in "*?["):
+            if fnmatch.fnmatchcase(relative_filename, pattern):
+                return template_name
+        elif relative_filename.startswith(pattern):
+            return template_name
+    return default
+
+
+def get_stale_reasons(
+    *,
+    input_filename: str,
+    template_name,
+    output_name,
+    force=False,
+    dict_mtime: float | None = None,
+    routes_mtime: float | None = None,
+    bread_mtime: float | None = None,
+    template: CompiledTemplate | None = None,
+) -> list[str]:
+    """Return the reasons why output_name has to be regenerated, or an empty list if it is fresh
+
+    template is compiled from template_name unless it is given.
+    Apart from compiling the template once, only stat calls are used
+    so that the freshness can be decided without reading any source file."""
+    if force:
+        return ["forced"]
+    if output_name == "-":
+        return ["standard output"]
+    try:
+        output_mtime = os.stat(output_name).st_mtime
+    except FileNotFoundError:
+        return ["no output"]
+
+    reasons = []
+    if os.stat(input_filename).st_mtime >= output_mtime:
+        reasons.append("newer source")
+    if template is None:
+        template = compile_template(template_name)
+    for path, mtime in template.dependencies.items():
+        if mtime >= output_mtime:
+            reasons.append("newer template" if path == template.name else "newer partial")
+            break
+    if dict_mtime is not None and dict_mtime >= output_mtime:
+        reasons.append("dict changed")
+    if routes_mtime is not None and routes_mtime >= output_mtime:
+        reasons.append("routes changed")
+    if bread_mtime is not None and bread_mtime >= output_mtime:
+        reasons.append("newer ancestor source")
+    return reasons
+
+
 def convert(
     *,
     input_filename: str,
@@ -137,8 +739,14 @@ def convert(
     bread=None,
     force=False,
     mydict: dict,
+    dict_mtime: float | None = None,
+    routes_mtime: float | None = None,
+    bread_mtime: float | None = None,
+    highlighter: Highlighter | None = None,
+    minify=False,
 ):
     isinstance(force, bool)
+    isinstance(minify, bool)
 
     (head, _) = os.path.split(output_name)
     if len(head) != 0:
@@ -149,19 +757,19 @@ def convert(
         title = get_title(content_text)
         og_description = get_og_description(content_text)
         check_unsupported_meta_tags(content_text)
-    with Path(template_name).open() as fp:
-        template = string.Template(fp.read())
+    template = compile_template(template_name)
 
-    if output_name == "-":
-        pass
-    else:
-        if (
-            not force
-            and os.path.exists(output_name)
-            and os.stat(input_filename).st_mtime < os.stat(output_name).st_mtime
-            and os.stat(template_name).st_mtime < os.stat(output_name).st_mtime
-        ):
-            return title
+    if not get_stale_reasons(
+        input_filename=input_filename,
+        template_name=template_name,
+        output_name=output_name,
+        force=force,
+        dict_mtime=dict_mtime,
+        routes_mtime=routes_mtime,
+        bread_mtime=bread_mtime,
+        template=template,
+    ):
+        return title
 
     content_text_cleaned = remove_meta_comments(content_text)
     content_text_cleaned = remove_html_comments_outside_code_fence(content_text_cleaned)
@@ -173,6 +781,8 @@ def convert(
             "footnotes",
         ],
     )
+    if highlighter is not None:
+        content_html = highlighter.highlight_html(content_html)
     if bread is None:
         bread = ""
     elif bread != "":
@@ -196,6 +806,8 @@ def convert(
             d[key] = value
 
     html = template.substitute(d)
+    if minify:
+        html = minify_html(html)
 
     with Path(output_name).open("w") as outf:
         outf.write(html)
@@ -221,6 +833,17 @@ def get_bread(pathroot, titles):
     return ret
 
 
+def get_bread_mtime(pathroot, mtimes) -> float | None:
+    """Return the latest mtime of the sources whose titles appear in the breadcrumb list of pathroot"""
+    paths = pathroot.split("/")
+    ret = None
+    for i in range(1, len(paths)):
+        mtime: float = mtimes["/".join(paths[:i])]
+        if ret is None or mtime > ret:
+            ret = mtime
+    return ret
+
+
 def clean_path(path):
     if path.endswith("/"):
         path = path[:-1]
@@ -238,19 +861,60 @@ def get_index_position(files):
     return -1
 
 
-def recursive(
-    *,
-    input_filename,
-    template_name,
-    output_name,
-    breads: list[str],
-    force=False,
-    mydict: dict,
-):
-    isinstance(force, bool)
+class DiskDict:
+    """A mapping kept in an on-disk SQLite database, used for titles and mtimes of breadcrumb pages
+
+    Memory usage does not depend on the number of stored items."""
+
+    def __init__(self, path: str):
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=OFF")
+        self.conn.execute("PRAGMA synchronous=OFF")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS items (key TEXT PRIMARY KEY, value NOT NULL)")
+
+    def __setitem__(self, key: str, value):
+        self.conn.execute("INSERT OR REPLACE INTO items (key, value) VALUES (?, ?)", (key, value))
+
+    def __getitem__(self, key: str):
+        row = self.conn.execute("SELECT value FROM items WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return row[0]
+
+    def close(self):
+        self.conn.close()
+
 
-    titles = {}
+class Progress:
+    """Report the number of processed pages and the throughput periodically"""
 
+    def __init__(self, *, interval: float = 1.0, stream=None):
+        self.interval = interval
+        self.stream = sys.stderr if stream is None else stream
+        self.done = 0
+        self.start = time.monotonic()
+        self.last = self.start
+
+    def report(self, now: float):
+        elapsed = now - self.start
+        rate = self.done / elapsed if elapsed > 0 else 0.0
+        print(f"{self.done} pages, {elapsed:.1f}s, {rate:.1f} pages/s", file=self.stream)
+
+    def update(self):
+        self.done += 1
+        now = time.monotonic()
+        if now - self.last >= self.interval:
+            self.last = now
+            self.report(now)
+
+    def finish(self):
+        self.report(time.monotonic())
+
+
+def iter_pages(input_filename: str, output_name: str) -> Iterator[tuple[str, str, str]]:
+    """Yield (source path, output root, output path) of markdown files in input_filename
+
+    index.md is yielded first in each directory so that its title is available for the breadcrumbs."""
     for root, _, files in os.walk(input_filename):
         # swap filenames to get names of index.md first
         index_pos = get_index_position(files)
@@ -264,28 +928,159 @@ def recursive(
             if myoutext not in [".md", ".mkd"]:
                 continue
             myoutname = os.path.join(output_name, myoutroot + ".html")
-            myoutroot2 = clean_path(myoutroot)
+            yield myfilename, myoutroot, myoutname
+
+
+def recursive(
+    *,
+    input_filename,
+    template_name,
+    output_name,
+    breads: list[str],
+    force=False,
+    mydict: dict,
+    routes: dict[str, str] | None = None,
+    dict_mtime: float | None = None,
+    routes_mtime: float | None = None,
+    highlighter: Highlighter | None = None,
+    minify=False,
+    scale_mode=False,
+    dry_run=False,
+    explain=False,
+):
+    isinstance(force, bool)
+    isinstance(scale_mode, bool)
+    isinstance(dry_run, bool)
+    isinstance(explain, bool)
+
+    kwargs = {
+        "input_filename": input_filename,
+        "template_name": template_name,
+        "output_name": output_name,
+        "breads": breads,
+        "force": force,
+        "mydict": mydict,
+        "routes": {} if routes is None else routes,
+        "dict_mtime": dict_mtime,
+        "routes_mtime": routes_mtime,
+        "dry_run": dry_run,
+        "explain": explain,
+        "highlighter": highlighter,
+        "minify": minify,
+    }
+    if scale_mode:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            titles = DiskDict(os.path.join(tmpdir, "titles.sqlite3"))
+            mtimes = DiskDict(os.path.join(tmpdir, "mtimes.sqlite3"))
+            progress = Progress()
+            try:
+                _recursive(**kwargs, titles=titles, mtimes=mtimes, progress=progress)
+            finally:
+                titles.close()
+                mtimes.close()
+            progress.finish()
+    else:
+        _recursive(**kwargs, titles={}, mtimes={}, progress=None)
+
+
+def _recursive(
+    *,
+    input_filename,
+    template_name,
+    output_name,
+    breads: list[str],
+    force: bool,
+    mydict: dict,
+    routes: dict[str, str],
+    dict_mtime: float | None,
+    routes_mtime: float | None,
+    dry_run: bool,
+    explain: bool,
+    highlighter: Highlighter | None,
+    minify: bool,
+    titles,
+    mtimes,
+    progress: Progress | None,
+):
+    num_pages = 0
+    num_stale = 0
+    total_size = 0
+    stale_size = 0
 
-            mybread = None
-            flg = False
-            for bread in breads:
-                if myoutroot.startswith(bread):
+    for myfilename, myoutroot, myoutname in iter_pages(input_filename, output_name):
+        myoutroot2 = clean_path(myoutroot)
+        source_stat = os.stat(myfilename)
+        mytemplate = get_template_name(
+            routes=routes,
+            relative_filename=myfilename[len(input_filename) + 1 :],
+            default=template_name,
+        )
+
+        mybread = None
+        bread_mtime = None
+        flg = False
+        for bread in breads:
+            if myoutroot.startswith(bread):
+                bread_mtime = get_bread_mtime(myoutroot2, mtimes)
+                if not dry_run:
                     mybread = get_bread(myoutroot2, titles)
-                    flg = True
-                    break
+                flg = True
+                break
 
-            title = convert(
+        if dry_run:
+            reasons = get_stale_reasons(
                 input_filename=myfilename,
-                template_name=template_name,
+                template_name=mytemplate,
                 output_name=myoutname,
-                bread=mybread,
                 force=force,
-                mydict=mydict,
+                dict_mtime=dict_mtime,
+                routes_mtime=routes_mtime,
+                bread_mtime=bread_mtime,
             )
-
+            num_pages += 1
+            total_size += source_stat.st_size
+            if reasons:
+                num_stale += 1
+                stale_size += source_stat.st_size
+            if explain:
+                if reasons:
+                    print(f"stale {myfilename} -> {myoutname}: {', '.join(reasons)}")
+                else:
+                    print(f"fresh {myfilename} -> {myoutname}")
             if flg:
-                titles[myoutroot2] = title
+                mtimes[myoutroot2] = source_stat.st_mtime
+            if progress is not None:
+                progress.update()
+            continue
+
+        title = convert(
+            input_filename=myfilename,
+            template_name=mytemplate,
+            output_name=myoutname,
+            bread=mybread,
+            force=force,
+            mydict=mydict,
+            dict_mtime=dict_mtime,
+            routes_mtime=routes_mtime,
+            bread_mtime=bread_mtime,
+            highlighter=highlighter,
+            minify=minify,
+        )
+
+        if flg:
+            titles[myoutroot2] = title
+            mtimes[myoutroot2] = source_stat.st_mtime
+        if progress is None:
             print(myfilename, myoutname, title)
+        else:
+            progress.update()
+
+    if dry_run:
+        ratio = 100 * stale_size / total_size if total_size > 0 else 0.0
+        print(
+            f"{num_stale} of {num_pages} pages would be regenerated, "
+            f"estimated cost {stale_size} of {total_size} source bytes ({ratio:.1f}%)"
+        )
 
 
 def main():
@@ -318,14 +1113,107 @@ def main():
         default=[],
         type=str,
     )
+    oparser.add_argument(
+        "--scale-mode",
+        dest="scale_mode",
+        action="store_true",
+        help="Keep memory usage independent of the number of pages and report progress instead of each file",
+        default=False,
+    )
+    oparser.add_argument(
+        "--dry-run",
+        dest="dry_run",
+        action="store_true",
+        help="Decide which pages would be regenerated without writing anything (with -R)",
+        default=False,
+    )
+    oparser.add_argument(
+        "--explain",
+        dest="explain",
+        action="store_true",
+        help="Show whether each page is stale or fresh and why (with --dry-run)",
+        default=False,
+    )
+    oparser.add_argument(
+        "--routes",
+        dest="routes",
+        help="JSON file path mapping path prefixes or glob patterns to templates (with -R)",
+        default=None,
+        type=Path,
+    )
+    oparser.add_argument(
+        "--highlight",
+        dest="highlight",
+        action="store_true",
+        help="Highlight fenced code blocks with Pygments",
+        default=False,
+    )
+    oparser.add_argument(
+        "--highlight-style", dest="highlight_style", help="Pygments style name", default="default", type=str
+    )
+    oparser.add_argument(
+        "--highlight-noclasses",
+        dest="highlight_noclasses",
+        action="store_true",
+        help="Use inline styles instead of CSS classes for highlighting",
+        default=False,
+    )
+    oparser.add_argument(
+        "--highlight-cache",
+        dest="highlight_cache",
+        help="Directory to cache highlighted code blocks",
+        default=None,
+        type=str,
+    )
+    oparser.add_argument(
+        "--highlight-cache-size",
+        dest="highlight_cache_size",
+        help="Maximum size of the highlight cache in megabytes",
+        default=100,
+        type=int,
+    )
+    oparser.add_argument(
+        "--minify",
+        dest="minify",
+        action="store_true",
+        help="Collapse whitespace in generated pages",
+        default=False,
+    )
     oparser.add_argument("--dict", dest="mydict", help="Keywords JSON file path", default=None, type=Path)
     opts = oparser.parse_args()
+    if opts.dry_run and not opts.recursive:
+        oparser.error("--dry-run requires -R")
+    if opts.explain and not opts.dry_run:
+        oparser.error("--explain requires --dry-run")
+    if opts.routes and not opts.recursive:
+        oparser.error("--routes requires -R")
 
     if opts.mydict:
         with opts.mydict.open() as fp:
             mydict = json.load(fp)
+        dict_mtime = opts.mydict.stat().st_mtime
     else:
         mydict = {}
+        dict_mtime = None
+
+    highlighter = None
+    if opts.highlight:
+        cache = None
+        if opts.highlight_cache:
+            cache = HighlightCache(opts.highlight_cache, max_bytes=opts.highlight_cache_size * 1024 * 1024)
+        highlighter = Highlighter(
+            style=opts.highlight_style,
+            noclasses=opts.highlight_noclasses,
+            cache=cache,
+        )
+
+    if opts.routes:
+        with opts.routes.open() as fp:
+            routes = json.load(fp)
+        routes_mtime = opts.routes.stat().st_mtime
+    else:
+        routes = {}
+        routes_mtime = None
 
     if opts.recursive:
         recursive(
@@ -335,6 +1223,14 @@ def main():
             breads=opts.breads,
             force=opts.force,
             mydict=mydict,
+            routes=routes,
+            dict_mtime=dict_mtime,
+            routes_mtime=routes_mtime,
+            highlighter=highlighter,
+            minify=opts.minify,
+            scale_mode=opts.scale_mode,
+            dry_run=opts.dry_run,
+            explain=opts.explain,
         )
     else:
         convert(
@@ -343,6 +1239,9 @@ def main():
             output_name=opts.output,
             force=opts.force,
             mydict=mydict,
+            dict_mtime=dict_mtime,
+            highlighter=highlighter,
+            minify=opts.minify,
         )
 
 
@@ -1,15 +1,41 @@
+import functools
+import gc
+import importlib.util
+import json
+import os
+import string
+import subprocess
 import sys
 import tempfile
+import time
+import timeit
+import tracemalloc
 import unittest
 from io import StringIO
 from pathlib import Path
+from unittest import mock
 
+import markdown
+
+from pagenerator import cli
 from pagenerator.cli import (
+    DiskDict,
+    HighlightCache,
+    Highlighter,
+    Progress,
     check_unsupported_meta_tags,
+    compile_template,
     convert,
+    get_bread,
     get_mydict,
     get_og_description,
+    get_stale_reasons,
+    get_template_name,
     get_title,
+    main,
+    minify_html,
+    recursive,
+    remove_code_blocks,
     remove_html_comments_outside_code_fence,
     remove_meta_comments,
 )
@@ -232,6 +258,15 @@ class TestCli(unittest.TestCase):
 """
         self.assertEqual(remove_html_comments_outside_code_fence(text), expected)
 
+    def test_remove_html_comments_outside_code_fence_joined_comment(self):
+        # Removing a comment can make a new comment from the text around it
+        text = "a<!<!-- x -->-- y -->b"
+        self.assertEqual(remove_html_comments_outside_code_fence(text), "ab")
+
+    def test_remove_code_blocks(self):
+        text = "a```b```c```d"
+        self.assertEqual(remove_code_blocks(text), "ac```d")
+
     def test_check_unsupported_meta_tags_no_unsupported(self):
         text = "# タイトル\n\n<!-- og:description: サポートされているタグ -->\n\n本文です。"
         # Capture stderr
@@ -462,5 +497,754 @@ class TestCli(unittest.TestCase):
             self.assertIn("デフォルトの説明文", output_content)
 
 
+class TestAdversarialInput(unittest.TestCase):
+    """Meta comment parsing must finish in linear time for inputs which made the regular expressions quadratic"""
+
+    num = 50000
+    max_seconds = 2.0
+
+    corpus = {
+        "unterminated og:description": "<!-- og:description: x\n" * num,
+        "unterminated og:description without colon": "<!-- og:description x " * num,
+        "openers before one close": "<!-- og:description: x\n" * num + "-->",
+        "unbalanced fences": "```\n" * (2 * num + 1) + "<!-- og:description: x" * num,
+        "spaces in value": "<!-- og:description: a" + " " * (num * 10) + "b",
+        "spaces before colon": "<!-- og:a" + " a" * num,
+        "openers before one colon": "<!-- twitter:a " * num + ": b",
+        "openers without spaces": "<!--a:b" * num,
+        "comments in one line": "<!-- a -->x" * num,
+        "unterminated comments in one line": "<!-- " * num,
+    }
+
+    def test_linear_time(self):
+        functions = [
+            get_og_description,
+            check_unsupported_meta_tags,
+            remove_meta_comments,
+            remove_html_comments_outside_code_fence,
+        ]
+        old_stderr = sys.stderr
+        sys.stderr = StringIO()
+        try:
+            for name, text in self.corpus.items():
+                for function in functions:
+                    with self.subTest(name=name, function=function.__name__):
+                        start = time.monotonic()
+                        function(text)
+                        self.assertLess(time.monotonic() - start, self.max_seconds)
+        finally:
+            sys.stderr = old_stderr
+
+    def test_remove_meta_comments_compatible(self):
+        # [^:]+ in the original pattern runs to the next colon over the end of the comment
+        text = "<!-- twitter:site @ex -->\nNote: x <!-- c -->\nz"
+        self.assertEqual(remove_meta_comments(text), "\nz")
+
+
+@unittest.skipIf(importlib.util.find_spec("pygments") is None, "Pygments is not installed")
+class TestHighlight(unittest.TestCase):
+    def test_highlight_html(self):
+        content_html = (
+            '<pre><code class="language-python">if a &lt; b: print(&quot;x&quot;)\n</code></pre>\n'
+            "<pre><code>plain\n</code></pre>\n"
+            '<pre><code class="language-nosuchlang">x\n</code></pre>'
+        )
+        output = Highlighter().highlight_html(content_html)
+        self.assertIn('<div class="codehilite"><pre>', output)
+        self.assertIn('<span class="k">if</span>', output)
+        self.assertIn("&lt;", output)
+        self.assertIn("<pre><code>plain\n</code></pre>", output)
+        self.assertIn('<pre><code class="language-nosuchlang">x\n</code></pre>', output)
+
+    def test_highlight_cache(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            highlighter = Highlighter(cache=HighlightCache(tmpdir, max_bytes=1024 * 1024))
+            first = highlighter.highlight("python", "x = 1\n")
+            self.assertEqual(len(list(Path(tmpdir).glob("*/*.html"))), 1)
+
+            # A new cache on the same directory returns the stored result without highlighting
+            cache = HighlightCache(tmpdir, max_bytes=1024 * 1024)
+            (path,) = cache.entries
+            path.write_text("cached")
+            self.assertEqual(Highlighter(cache=cache).highlight("python", "x = 1\n"), "cached")
+            # Different options are cached separately
+            self.assertNotEqual(Highlighter(cache=cache, noclasses=True).highlight("python", "x = 1\n"), first)
+            self.assertEqual(len(list(Path(tmpdir).glob("*/*.html"))), 2)
+
+    def test_highlight_cache_counts_entries_from_other_processes(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cache = HighlightCache(tmpdir, max_bytes=250)
+            other = HighlightCache(tmpdir, max_bytes=250)
+            other.put("00key", "x" * 100)
+            self.assertEqual(cache.get("00key"), "x" * 100)
+            self.assertEqual(cache.total, 100)
+            cache.put("01key", "x" * 100)
+            cache.put("02key", "x" * 100)
+            self.assertLessEqual(cache.total, 250)
+            self.assertLessEqual(sum(p.stat().st_size for p in Path(tmpdir).glob("*/*.html")), 250)
+
+    def test_highlight_cache_concurrent_put(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cache = HighlightCache(tmpdir, max_bytes=1024 * 1024)
+            other = HighlightCache(tmpdir, max_bytes=1024 * 1024)
+            orig_replace = os.replace
+
+            def replace(src, dst):
+                # Another process writes the same entry while this one is about to move its file
+                with mock.patch.object(cli.os, "replace", orig_replace):
+                    other.put("00key", "other")
+                orig_replace(src, dst)
+
+            with mock.patch.object(cli.os, "replace", replace):
+                cache.put("00key", "mine")
+            self.assertEqual(cache.get("00key"), "mine")
+            self.assertEqual(list(Path(tmpdir).glob("*/*.tmp")), [])
+
+    def test_highlight_cache_evicted_by_other_processes(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cache = HighlightCache(tmpdir, max_bytes=1024 * 1024)
+            cache.put("00key", "x" * 100)
+            # Removed after reading it
+            with mock.patch.object(cli.os, "utime", side_effect=FileNotFoundError):
+                self.assertEqual(cache.get("00key"), "x" * 100)
+            self.assertEqual(cache.entries, {})
+            self.assertEqual(cache.total, 0)
+
+            # Removed between listing and stat
+            missing = cache.path("01key")
+            with mock.patch.object(Path, "glob", return_value=iter([missing, cache.path("00key")])):
+                other = HighlightCache(tmpdir, max_bytes=1024 * 1024)
+            self.assertEqual(list(other.entries), [cache.path("00key")])
+            self.assertEqual(other.total, 100)
+
+    def test_highlight_cache_eviction(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cache = HighlightCache(tmpdir, max_bytes=250)
+            for i in range(5):
+                cache.put(f"{i:02d}key", "x" * 100)
+                # Make the order of use deterministic
+                cache.entries[cache.path(f"{i:02d}key")] = (i, 100)
+            self.assertLessEqual(cache.total, 250)
+            self.assertIsNone(cache.get("00key"))
+            self.assertEqual(cache.get("04key"), "x" * 100)
+
+    def test_convert_with_highlighter(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            tmpdir_path = Path(tmpdir)
+            md_file = tmpdir_path / "test.md"
+            md_file.write_text("# タイトル\n\n```python\nimport os\n```\n")
+            template_file = tmpdir_path / "template.html"
+            template_file.write_text("$content")
+            output_file = tmpdir_path / "output.html"
+
+            convert(
+                input_filename=str(md_file),
+                template_name=str(template_file),
+                output_name=str(output_file),
+                mydict={},
+                force=True,
+                highlighter=Highlighter(),
+            )
+            self.assertIn('<span class="kn">import</span>', output_file.read_text())
+
+
+class TestMinify(unittest.TestCase):
+    def test_minify_html(self):
+        text = "<ul>\n    <li>a  b</li>\n\n\t<li>\tc</li>\u3000\u3000</ul>"
+        self.assertEqual(minify_html(text), "<ul>\n<li>a b</li>\n<li> c</li>\u3000\u3000</ul>")
+
+    def test_minify_html_keeps_pre_code_script(self):
+        text = (
+            "<div>\n  <PRE>  x\n\n    y</PRE>\n  <code>a  b</code>  "
+            "<script>\nif (a  <  b) {\n    f();\n}\n</script>  <style>\n  p {  }\n</style>\n</div>"
+        )
+        expected = (
+            "<div>\n<PRE>  x\n\n    y</PRE>\n<code>a  b</code> "
+            "<script>\nif (a  <  b) {\n    f();\n}\n</script> <style>\n  p {  }\n</style>\n</div>"
+        )
+        self.assertEqual(minify_html(text), expected)
+
+    def test_minify_html_keeps_attribute_values(self):
+        text = (
+            '<input  type="text"\n    value="a  b">  <div title=\'x\n\ny\' data-json=\'{"a":  "b > c"}\'>  d  e</div>'
+        )
+        expected = '<input type="text"\nvalue="a  b"> <div title=\'x\n\ny\' data-json=\'{"a":  "b > c"}\'> d e</div>'
+        self.assertEqual(minify_html(text), expected)
+        # Quotes outside tags do not protect whitespace
+        self.assertEqual(minify_html('<p>don\'t  "a  b"</p>'), '<p>don\'t "a b"</p>')
+        self.assertEqual(minify_html('a < b  <p x="1'), 'a < b <p x="1')
+
+    def test_minify_html_linear_time(self):
+        for text in [
+            '<a "' * 50000,
+            "<a '" * 50000 + '"',
+            "<a " * 50000,
+            '<a x="' + "  " * 100000,
+            '<a x="y"' + " b" * 100000,
+        ]:
+            with self.subTest(text=text[:10]):
+                start = time.monotonic()
+                minify_html(text)
+                self.assertLess(time.monotonic() - start, 2.0)
+
+    def test_minify_html_lower_changes_length(self):
+        # "İ".lower() is two characters, which must not shift the protected range
+        text = "İ" * 10 + "<pre>a</pre><pre>b  c\n\n  d</pre>  <PRE>e  f</Pre>"
+        self.assertEqual(minify_html(text), "İ" * 10 + "<pre>a</pre><pre>b  c\n\n  d</pre> <PRE>e  f</Pre>")
+
+    def test_minify_html_unclosed(self):
+        text = "a  b<pre>  c  d"
+        self.assertEqual(minify_html(text), "a b<pre>  c  d")
+
+    def test_convert_minify_only_rewritten_pages(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            tmpdir_path = Path(tmpdir)
+            md_file = tmpdir_path / "test.md"
+            md_file.write_text("# タイトル\n\n本文です。\n")
+            template_file = tmpdir_path / "template.html"
+            template_file.write_text("<body>\n    $content\n</body>")
+            output_file = tmpdir_path / "output.html"
+            kwargs = {
+                "input_filename": str(md_file),
+                "template_name": str(template_file),
+                "output_name": str(output_file),
+                "mydict": {},
+                "minify": True,
+            }
+
+            convert(**kwargs)
+            self.assertEqual(output_file.read_text(), "<body>\n<h1>タイトル</h1>\n<p>本文です。</p>\n</body>")
+            os.utime(md_file, (100, 100))
+            os.utime(template_file, (100, 100))
+            with mock.patch.object(cli, "minify_html") as minify:
+                convert(**kwargs)
+                minify.assert_not_called()
+
+    @unittest.skipUnless(os.environ.get("PAGENERATOR_BENCHMARK"), "Set PAGENERATOR_BENCHMARK=1 to run benchmarks")
+    def test_minify_html_benchmark(self):
+        """Minification must take only a small part of the time for generating a page"""
+        bread = get_bread(
+            "sub/a/b/c/d/page", {"sub": "S", "sub/a": "A", "sub/a/b": "B", "sub/a/b/c": "C", "sub/a/b/c/d": "D"}
+        )
+        md = "# Title\n\n" + "Some *text* with `code`.\n\n- item\n- item\n\n```python\nif  a:\n    b()\n```\n\n" * 20
+        samples_template = (Path(__file__).parent.parent / "samples" / "template.html").read_text()
+        page = string.Template(samples_template).substitute(
+            {"title": "Title", "bread": bread, "content": markdown.markdown(md, extensions=["fenced_code"])}
+        )
+
+        # Compare the best of several runs to reduce the noise of a loaded machine
+        convert_time = min(
+            timeit.repeat(
+                lambda: markdown.markdown(md, extensions=["fenced_code", "tables", "footnotes"]), number=20, repeat=5
+            )
+        )
+        minify_time = min(timeit.repeat(lambda: minify_html(page), number=20, repeat=5))
+
+        self.assertLess(len(minify_html(page)), len(page))
+        self.assertLess(minify_time, convert_time * 0.1)
+
+
+class TestTemplate(unittest.TestCase):
+    def test_compile_template_same_as_string_template(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            template_file = Path(tmpdir) / "template.html"
+            text = "<title>${title}</title>\n$$5 $content$bread"
+            template_file.write_text(text)
+            d = {"title": "タイトル", "content": "<p>本文</p>", "bread": 1}
+            self.assertEqual(compile_template(str(template_file)).substitute(d), string.Template(text).substitute(d))
+            with self.assertRaises(KeyError):
+                compile_template(str(template_file)).substitute({})
+
+    def test_compile_template_invalid_placeholder(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            template_file = Path(tmpdir) / "template.html"
+            template_file.write_text("foo\nbar $ baz")
+            with self.assertRaisesRegex(ValueError, "line 2, col 5"):
+                compile_template(str(template_file))
+
+    def test_compile_template_include(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            tmpdir_path = Path(tmpdir)
+            (tmpdir_path / "partials").mkdir()
+            (tmpdir_path / "partials" / "header.html").write_text("<h1>$title</h1>${include:nav.html}")
+            (tmpdir_path / "partials" / "nav.html").write_text("<nav>$bread</nav>")
+            template_file = tmpdir_path / "template.html"
+            template_file.write_text("${include:partials/header.html}$content")
+
+            template = compile_template(str(template_file))
+            self.assertEqual(
+                template.substitute({"title": "T", "bread": "B", "content": "C"}),
+                "<h1>T</h1><nav>B</nav>C",
+            )
+            self.assertEqual(
+                set(template.dependencies),
+                {
+                    str(template_file),
+                    str(tmpdir_path / "partials" / "header.html"),
+                    str(tmpdir_path / "partials" / "nav.html"),
+                },
+            )
+            self.assertIs(compile_template(str(template_file)), template)
+
+            (tmpdir_path / "partials" / "nav.html").write_text("<nav>$title</nav>")
+            os.utime(tmpdir_path / "partials" / "nav.html", (1, 1))
+            self.assertEqual(
+                compile_template(str(template_file)).substitute({"title": "T", "content": "C"}),
+                "<h1>T</h1><nav>T</nav>C",
+            )
+
+    def test_compile_template_recursive_include(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            template_file = Path(tmpdir) / "template.html"
+            for include in ("template.html", "./template.html", "../" + Path(tmpdir).name + "/template.html"):
+                with self.subTest(include=include):
+                    template_file.write_text(f"${{include:{include}}}")
+                    with self.assertRaisesRegex(ValueError, "Recursive include"):
+                        compile_template(str(template_file))
+
+    def test_convert_compiles_template_once(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            tmpdir_path = Path(tmpdir)
+            md_file = tmpdir_path / "test.md"
+            md_file.write_text("# タイトル\n")
+            template_file = tmpdir_path / "template.html"
+            template_file.write_text("$content")
+            output_file = tmpdir_path / "output.html"
+            kwargs = {
+                "input_filename": str(md_file),
+                "template_name": str(template_file),
+                "output_name": str(output_file),
+                "mydict": {},
+            }
+            convert(**kwargs)
+            with mock.patch.object(cli, "compile_template", wraps=compile_template) as compile_mock:
+                convert(**kwargs)
+                self.assertEqual(compile_mock.call_count, 1)
+
+    def test_compile_template_cache_size(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            names = []
+            for i in range(cli.TEMPLATE_CACHE_SIZE + 3):
+                template_file = Path(tmpdir) / f"template{i}.html"
+                template_file.write_text(f"{i} $content")
+                names.append(str(template_file))
+                compile_template(str(template_file))
+            self.assertEqual(len(cli._template_cache), cli.TEMPLATE_CACHE_SIZE)
+            self.assertNotIn(names[0], cli._template_cache)
+            self.assertIn(names[-1], cli._template_cache)
+
+    def test_compile_template_partials_not_counted(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            tmpdir_path = Path(tmpdir)
+            for i in range(cli.TEMPLATE_CACHE_SIZE):
+                (tmpdir_path / f"partial{i}.html").write_text(f"{i}")
+            include = "".join(f"${{include:partial{i}.html}}" for i in range(cli.TEMPLATE_CACHE_SIZE))
+            names = []
+            for i in range(cli.TEMPLATE_CACHE_SIZE):
+                template_file = tmpdir_path / f"template{i}.html"
+                template_file.write_text(f"{include} $content")
+                names.append(str(template_file))
+                compile_template(str(template_file))
+            for name in names:
+                self.assertIn(name, cli._template_cache)
+
+    def test_get_template_name(self):
+        routes = {"blog/": "blog.html", "*/news-*.md": "news.html"}
+        self.assertEqual(get_template_name(routes=routes, relative_filename="blog/a.md", default="t.html"), "blog.html")
+        self.assertEqual(
+            get_template_name(routes=routes, relative_filename="docs/news-1.md", default="t.html"), "news.html"
+        )
+        self.assertEqual(get_template_name(routes=routes, relative_filename="docs/a.md", default="t.html"), "t.html")
+
+    def test_get_stale_reasons_newer_partial(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            tmpdir_path = Path(tmpdir)
+            md_file = tmpdir_path / "test.md"
+            md_file.write_text("# タイトル\n")
+            partial_file = tmpdir_path / "footer.html"
+            partial_file.write_text("footer")
+            template_file = tmpdir_path / "template.html"
+            template_file.write_text("$content${include:footer.html}")
+            output_file = tmpdir_path / "output.html"
+            output_file.write_text("")
+            os.utime(md_file, (100, 100))
+            os.utime(template_file, (100, 100))
+            os.utime(partial_file, (300, 300))
+            os.utime(output_file, (200, 200))
+
+            reasons = get_stale_reasons(
+                input_filename=str(md_file),
+                template_name=str(template_file),
+                output_name=str(output_file),
+            )
+            self.assertEqual(reasons, ["newer partial"])
+
+
+class TestRecursive(unittest.TestCase):
+    def make_tree(self, root: Path):
+        (root / "sub" / "2").mkdir(parents=True)
+        (root / "index.md").write_text("# トップ\n")
+        (root / "sub" / "index.md").write_text("# サブ\n")
+        (root / "sub" / "bar.md").write_text("# バー\n")
+        (root / "sub" / "2" / "index.md").write_text("# 2\n")
+        (root / "sub" / "2" / "foo.md").write_text("# フー\n")
+
+    def run_recursive(self, *, scale_mode: bool) -> str:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            tmpdir_path = Path(tmpdir)
+            self.make_tree(tmpdir_path / "src")
+            template_file = tmpdir_path / "template.html"
+            template_file.write_text("$bread")
+
+            old_stdout, old_stderr = sys.stdout, sys.stderr
+            sys.stdout, sys.stderr = StringIO(), StringIO()
+            try:
+                recursive(
+                    input_filename=str(tmpdir_path / "src"),
+                    template_name=str(template_file),
+                    output_name=str(tmpdir_path / "out"),
+                    breads=["sub/"],
+                    mydict={},
+                    scale_mode=scale_mode,
+                )
+                stdout = sys.stdout.getvalue()
+            finally:
+                sys.stdout, sys.stderr = old_stdout, old_stderr
+
+            if scale_mode:
+                self.assertEqual(stdout, "")
+            return (tmpdir_path / "out" / "sub" / "2" / "foo.html").read_text()
+
+    def test_recursive_scale_mode_same_output(self):
+        output = self.run_recursive(scale_mode=True)
+        self.assertIn('<span itemprop="name">サブ</span>', output)
+        self.assertIn('<span itemprop="name">2</span>', output)
+        self.assertEqual(output, self.run_recursive(scale_mode=False))
+
+    def measure_retained_memory(self, *, scale_mode: bool, num_pages: int, title_length: int) -> int:
+        """Return the bytes allocated by Python and still alive at the end of the traversal
+
+        The title and mtime stores are alive at that point, so the result includes them."""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            tmpdir_path = Path(tmpdir)
+            src = tmpdir_path / "src"
+            pages_per_dir = 100
+            for i in range(0, num_pages, pages_per_dir):
+                mydir = src / "sub" / f"d{i // pages_per_dir}"
+                mydir.mkdir(parents=True)
+                (mydir / "index.md").write_text(f"# {i} {'x' * title_length}\n")
+                for j in range(1, min(pages_per_dir, num_pages - i)):
+                    (mydir / f"p{j}.md").write_text(f"# {i + j} {'x' * title_length}\n")
+            (src / "sub" / "index.md").write_text("# Sub\n")
+            template_file = tmpdir_path / "template.html"
+            template_file.write_text("$title")
+
+            retained = []
+            orig_recursive = cli._recursive
+
+            def measured_recursive(**kwargs):
+                gc.collect()
+                start = tracemalloc.get_traced_memory()[0]
+                orig_recursive(**kwargs)
+                gc.collect()
+                retained.append(tracemalloc.get_traced_memory()[0] - start)
+
+            with (
+                open(os.devnull, "w") as devnull,
+                mock.patch.object(sys, "stdout", devnull),
+                mock.patch.object(sys, "stderr", devnull),
+                mock.patch.object(cli, "_recursive", measured_recursive),
+            ):
+                tracemalloc.start()
+                try:
+                    recursive(
+                        input_filename=str(src),
+                        template_name=str(template_file),
+                        output_name=str(tmpdir_path / "out"),
+                        breads=["sub/"],
+                        mydict={},
+                        scale_mode=scale_mode,
+                    )
+                finally:
+                    tracemalloc.stop()
+            return retained[0]
+
+    def test_recursive_scale_mode_memory(self):
+        num_pages = 100
+        title_length = 8000
+        titles_size = num_pages * title_length
+        # Titles kept in memory are detected by this measurement
+        self.assertGreater(
+            self.measure_retained_memory(scale_mode=False, num_pages=num_pages, title_length=title_length),
+            titles_size,
+        )
+        self.assertLess(
+            self.measure_retained_memory(scale_mode=True, num_pages=num_pages, title_length=title_length),
+            titles_size / 4,
+        )
+
+    def test_recursive_routes(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            tmpdir_path = Path(tmpdir)
+            src = tmpdir_path / "src"
+            out = tmpdir_path / "out"
+            self.make_tree(src)
+            template_file = tmpdir_path / "template.html"
+            template_file.write_text("default $title")
+            sub_template_file = tmpdir_path / "sub.html"
+            sub_template_file.write_text("sub $title")
+            foo_template_file = tmpdir_path / "foo.html"
+            foo_template_file.write_text("foo $title")
+
+            old_stdout = sys.stdout
+            sys.stdout = StringIO()
+            try:
+                recursive(
+                    input_filename=str(src),
+                    template_name=str(template_file),
+                    output_name=str(out),
+                    breads=[],
+                    mydict={},
+                    routes={"*/foo.md": str(foo_template_file), "sub/": str(sub_template_file)},
+                )
+            finally:
+                sys.stdout = old_stdout
+
+            self.assertEqual((out / "index.html").read_text(), "default トップ")
+            self.assertEqual((out / "sub" / "bar.html").read_text(), "sub バー")
+            self.assertEqual((out / "sub" / "2" / "foo.html").read_text(), "foo フー")
+
+    def test_main_routes_changed(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            tmpdir_path = Path(tmpdir)
+            src = tmpdir_path / "src"
+            out = tmpdir_path / "out"
+            (src / "sub").mkdir(parents=True)
+            (src / "sub" / "a.md").write_text("# A\n")
+            template_file = tmpdir_path / "new.html"
+            template_file.write_text("NEW $content")
+            old_template_file = tmpdir_path / "old.html"
+            old_template_file.write_text("OLD $content")
+            os.utime(old_template_file, (100, 100))
+            routes_file = tmpdir_path / "routes.json"
+            routes_file.write_text("{}")
+            os.utime(routes_file, (100, 100))
+            args = ["pagenerator", "-R", "-i", str(src), "-o", str(out), "-t", str(template_file)]
+            args += ["--routes", str(routes_file)]
+
+            with mock.patch.object(sys, "stdout", StringIO()) as stdout:
+                with mock.patch.object(sys, "argv", args):
+                    main()
+                self.assertEqual((out / "sub" / "a.html").read_text(), "NEW <h1>A</h1>")
+
+                routes_file.write_text(json.dumps({"sub/": str(old_template_file)}))
+                with mock.patch.object(sys, "argv", args + ["--dry-run", "--explain"]):
+                    main()
+                    self.assertIn(": routes changed\n", stdout.getvalue())
+                with mock.patch.object(sys, "argv", args):
+                    main()
+            self.assertEqual((out / "sub" / "a.html").read_text(), "OLD <h1>A</h1>")
+
+    def test_main_rejects_options_without_recursive(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            tmpdir_path = Path(tmpdir)
+            md_file = tmpdir_path / "test.md"
+            md_file.write_text("# タイトル\n")
+            template_file = tmpdir_path / "template.html"
+            template_file.write_text("$content")
+            output_file = tmpdir_path / "out" / "output.html"
+            routes_file = tmpdir_path / "routes.json"
+            routes_file.write_text("{}")
+            args = ["pagenerator", "-i", str(md_file), "-o", str(output_file), "-t", str(template_file)]
+
+            for extra in (
+                ["--dry-run"],
+                ["--dry-run", "--explain"],
+                ["-R", "--explain"],
+                ["--routes", str(routes_file)],
+            ):
+                with self.subTest(extra=extra):
+                    with mock.patch.object(sys, "argv", args + extra), mock.patch.object(sys, "stderr", StringIO()):
+                        with self.assertRaises(SystemExit):
+                            main()
+                    self.assertFalse(output_file.exists())
+
+    def test_disk_dict(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            titles = DiskDict(os.path.join(tmpdir, "titles.sqlite3"))
+            try:
+                titles["sub"] = "サブ"
+                titles["sub"] = "サブ2"
+                titles["mtime"] = 1.5
+                self.assertEqual(titles["sub"], "サブ2")
+                self.assertEqual(titles["mtime"], 1.5)
+                with self.assertRaises(KeyError):
+                    titles["other"]
+            finally:
+                titles.close()
+
+    def test_get_stale_reasons(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            tmpdir_path = Path(tmpdir)
+            md_file = tmpdir_path / "test.md"
+            md_file.write_text("# タイトル\n")
+            template_file = tmpdir_path / "template.html"
+            template_file.write_text("$content")
+            output_file = tmpdir_path / "output.html"
+            stale_reasons = functools.partial(
+                get_stale_reasons,
+                input_filename=str(md_file),
+                template_name=str(template_file),
+                output_name=str(output_file),
+            )
+
+            self.assertEqual(stale_reasons(), ["no output"])
+            output_file.write_text("")
+            os.utime(md_file, (100, 100))
+            os.utime(template_file, (100, 100))
+            os.utime(output_file, (200, 200))
+            self.assertEqual(stale_reasons(), [])
+            self.assertEqual(stale_reasons(force=True), ["forced"])
+            self.assertEqual(
+                stale_reasons(dict_mtime=300, bread_mtime=300),
+                ["dict changed", "newer ancestor source"],
+            )
+            os.utime(md_file, (300, 300))
+            os.utime(template_file, (300, 300))
+            self.assertEqual(stale_reasons(), ["newer source", "newer template"])
+
+    def test_recursive_dry_run_explain(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            tmpdir_path = Path(tmpdir)
+            src = tmpdir_path / "src"
+            out = tmpdir_path / "out"
+            self.make_tree(src)
+            template_file = tmpdir_path / "template.html"
+            template_file.write_text("$bread")
+            kwargs = {
+                "input_filename": str(src),
+                "template_name": str(template_file),
+                "output_name": str(out),
+                "breads": ["sub/"],
+                "mydict": {},
+            }
+
+            old_stdout = sys.stdout
+            sys.stdout = StringIO()
+            try:
+                recursive(**kwargs)
+                for path in src.rglob("*.md"):
+                    os.utime(path, (100, 100))
+                os.utime(template_file, (100, 100))
+                for path in out.rglob("*.html"):
+                    os.utime(path, (200, 200))
+                os.utime(src / "sub" / "2" / "index.md", (300, 300))
+
+                sys.stdout = StringIO()
+                recursive(**kwargs, dry_run=True, explain=True)
+                lines = sys.stdout.getvalue().splitlines()
+            finally:
+                sys.stdout = old_stdout
+
+            self.assertIn(f"stale {src}/sub/2/index.md -> {out}/sub/2/index.html: newer source", lines)
+            self.assertIn(f"stale {src}/sub/2/foo.md -> {out}/sub/2/foo.html: newer ancestor source", lines)
+            self.assertIn(f"fresh {src}/sub/bar.md -> {out}/sub/bar.html", lines)
+            self.assertEqual(
+                lines[-1], "2 of 5 pages would be regenerated, estimated cost 13 of 43 source bytes (30.2%)"
+            )
+            # Nothing is written in dry-run mode
+            self.assertEqual((out / "sub" / "2" / "foo.html").stat().st_mtime, 200)
+
+    def test_progress(self):
+        stream = StringIO()
+        progress = Progress(interval=3600, stream=stream)
+        for _ in range(3):
+            progress.update()
+        self.assertEqual(stream.getvalue(), "")
+        progress.finish()
+        self.assertRegex(stream.getvalue(), r"^3 pages, [0-9.]+s, [0-9.]+ pages/s\n$")
+
+
+@unittest.skipUnless(os.environ.get("PAGENERATOR_BENCHMARK"), "Set PAGENERATOR_BENCHMARK=1 to run benchmarks")
+class TestRecursiveScale(unittest.TestCase):
+    """Build synthetic trees of N and 4N pages in scale mode and check that RSS stays flat and time grows linearly
+
+    N can be raised with PAGENERATOR_SCALE_PAGES (e.g. 250000 for one million pages).
+    TestRecursive.test_recursive_scale_mode_memory checks the memory of the title store in every run."""
+
+    num_pages = int(os.environ.get("PAGENERATOR_SCALE_PAGES", "1000"))
+    max_rss_growth_mb = 5
+    max_time_ratio = 6
+
+    # Run the CLI and report the peak RSS of the process itself on the last line of stderr
+    runner = (
+        "import resource, runpy, sys\n"
+        "sys.argv = ['pagenerator'] + sys.argv[1:]\n"
+        "try:\n"
+        "    runpy.run_module('pagenerator.cli', run_name='__main__')\n"
+        "finally:\n"
+        "    print('maxrss', resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, file=sys.stderr)\n"
+    )
+
+    def build(self, tmpdir_path: Path, num_pages: int) -> tuple[float, float]:
+        """Return the elapsed seconds and the peak RSS in megabytes"""
+        src = tmpdir_path / f"src{num_pages}"
+        out = tmpdir_path / f"out{num_pages}"
+        pages_per_dir = 100
+        for i in range(0, num_pages, pages_per_dir):
+            mydir = src / "sub" / f"d{i // pages_per_dir}"
+            mydir.mkdir(parents=True)
+            (mydir / "index.md").write_text(f"# Dir {i}\n")
+            for j in range(1, min(pages_per_dir, num_pages - i)):
+                (mydir / f"p{j}.md").write_text(f"# Page {i + j}\n\nbody\n")
+        (src / "sub" / "index.md").write_text("# Sub\n")
+        template_file = tmpdir_path / "template.html"
+        template_file.write_text("$title $bread $content")
+
+        start = time.monotonic()
+        proc = subprocess.run(
+            [
+                sys.executable,
+                "-c",
+                self.runner,
+                "-R",
+                "--scale-mode",
+                "-i",
+                str(src),
+                "-o",
+                str(out),
+                "-t",
+                str(template_file),
+                "--breads",
+                "sub/",
+            ],
+            check=True,
+            capture_output=True,
+            text=True,
+        )
+        elapsed = time.monotonic() - start
+
+        self.assertTrue((out / "sub" / "d0" / "p1.html").exists())
+        # Progress is reported on stderr instead of a line per file on stdout
+        self.assertEqual(proc.stdout, "")
+        *progress_lines, rss_line = proc.stderr.splitlines()
+        self.assertRegex(progress_lines[-1], rf"^{num_pages + 1} pages, [0-9.]+s, [0-9.]+ pages/s$")
+
+        # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+        rss_mb = int(rss_line.split()[1]) / 1024
+        if sys.platform == "darwin":
+            rss_mb /= 1024
+        return elapsed, rss_mb
+
+    def test_scale(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            tmpdir_path = Path(tmpdir)
+            (small_time, small_rss) = self.build(tmpdir_path, self.num_pages)
+            (large_time, large_rss) = self.build(tmpdir_path, 4 * self.num_pages)
+
+            self.assertLess(large_rss - small_rss, self.max_rss_growth_mb)
+            self.assertLess(large_time, small_time * self.max_time_ratio)
+
+
 if __name__ == "__main__":
     unittest.main()